@@ -1,21 +1,307 @@
-import ee
 import datetime
+import functools
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import logging
+from raster_cache import RasterCache, etiquetar_zonas, mascara_deforestacion
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-try:
-    ee.Initialize(project='ornate-shine-310021')
-    logger.info("Conexión con Google Earth Engine exitosa.")
-except Exception as e:
-    logger.error(f"Error al inicializar Google Earth Engine: {e}")
+EE_PROJECT = os.environ.get('EE_PROJECT', 'ornate-shine-310021')
+EE_INIT_MAX_BACKOFF_SECONDS = int(os.environ.get('EE_INIT_MAX_BACKOFF_SECONDS', 60))
+# Cada cuánto una réplica lista vuelve a comprobar que Earth Engine responde.
+READINESS_CHECK_INTERVAL_SECONDS = int(os.environ.get('READINESS_CHECK_INTERVAL_SECONDS', 60))
+LANDSAT_COLLECTION = 'LANDSAT/LC08/C02/T1_L2'
+
+# Parámetros de visualización compartidos por las vistas. Si cambian, incrementar
+# ALGORITHM_VERSION para invalidar ETags y rasters cacheados.
+VIS_PARAMS = {
+    'NDVI': {'min': -0.1, 'max': 0.9, 'palette': ['#8c510a', '#d8b365', '#f6e8c3', '#c7eae5', '#5ab4ac', '#01665e']},
+    'SAVI': {'min': 0, 'max': 1, 'palette': ['brown', 'yellow', 'lightgreen', 'green', 'darkgreen']}, # Rango típico para SAVI
+    'NBR': {'min': -1, 'max': 1, 'palette': ['red', 'orange', 'yellow', 'lightgreen', 'darkgreen']}, # Rango típico para NBR
+    'DIFF': {'min': -0.5, 'max': 0.5, 'palette': ['red', 'yellow', 'white', 'cyan', 'green']}
+}
+CLOUD_OVERLAY_RGB = [140, 160, 180] # RGB for metallic blue
+
+# El cliente de Earth Engine se importa e inicializa en segundo plano; hasta entonces
+# `ee` es None y las rutas que lo usan responden 503 (ver `exigir_earth_engine`).
+ee = None
+_estado_inicio = {
+    'earthEngine': False,
+    'caches': False,
+    'attempts': 0,
+    'lastError': None,
+    'lastCheck': None,
+    'readySince': None,
+    'collection': None
+}
+_estado_inicio_lock = threading.Lock()
+_listo = threading.Event()
+# Objetos de Earth Engine reutilizados por las vistas; se construyen al inicializar EE.
+_objetos_compartidos = {}
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*", "methods": ["GET", "POST", "OPTIONS"], "allow_headers": ["Content-Type", "Authorization"]}})
 
+# Versión del algoritmo de mosaicos/visualización. Incrementar cuando cambie el
+# cálculo de índices, paletas o ventanas de fechas para invalidar los ETags emitidos.
+ALGORITHM_VERSION = '1'
+# Vida útil asumida de un map ID de Earth Engine (segundos).
+MAP_ID_TTL_SECONDS = int(os.environ.get('MAP_ID_TTL_SECONDS', 7200))
+# Vida útil para ventanas que aún no han cerrado y pueden recibir nuevas escenas.
+RECENT_WINDOW_TTL_SECONDS = int(os.environ.get('RECENT_WINDOW_TTL_SECONDS', 900))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 512))
+WINDOW_HALF_DAYS = 60
+
+raster_cache = RasterCache(
+    directorio=os.environ.get('RASTER_CACHE_DIR'),
+    max_bytes=int(os.environ.get('RASTER_CACHE_MAX_BYTES', 512 * 1024 * 1024)),
+    max_workers=int(os.environ.get('RASTER_CACHE_WORKERS', 8)),
+    registrar_existentes=False
+)
+
+def _actualizar_estado(**cambios):
+    """Actualiza el estado y marca la réplica como lista solo si EE y las cachés lo están."""
+    with _estado_inicio_lock:
+        _estado_inicio.update(cambios)
+        if _estado_inicio['earthEngine'] and _estado_inicio['caches']:
+            if not _listo.is_set():
+                _estado_inicio['readySince'] = datetime.datetime.utcnow().isoformat() + 'Z'
+                _listo.set()
+        else:
+            _estado_inicio['readySince'] = None
+            _listo.clear()
+
+def _supervisar_earth_engine():
+    """Inicializa Earth Engine con reintentos y después comprueba periódicamente que siga accesible.
+
+    Tras inicializar se construyen los objetos que reutilizan las vistas (colección Landsat
+    base y capa de nubes, en `_objetos_compartidos`). La comprobación periódica consulta
+    los metadatos de la colección, que solo se informan en /readyz. Si falla, la réplica
+    deja de estar lista y se vuelve a inicializar con espera exponencial.
+    """
+    global ee
+    espera = 1
+    inicializado = False
+    while True:
+        try:
+            if not inicializado:
+                with _estado_inicio_lock:
+                    _estado_inicio['attempts'] += 1
+                import ee as ee_module
+                ee_module.Initialize(project=EE_PROJECT)
+                _objetos_compartidos.update(
+                    coleccion=ee_module.ImageCollection(LANDSAT_COLLECTION),
+                    capa_nubes=ee_module.Image.constant(CLOUD_OVERLAY_RGB).uint8()
+                )
+                ee = ee_module
+                inicializado = True
+            metadatos = ee.data.getAsset(LANDSAT_COLLECTION)
+            if not _estado_inicio['earthEngine']:
+                logger.info("Conexión con Google Earth Engine exitosa.")
+            _actualizar_estado(
+                earthEngine=True,
+                lastError=None,
+                lastCheck=datetime.datetime.utcnow().isoformat() + 'Z',
+                collection={'id': LANDSAT_COLLECTION, 'updateTime': metadatos.get('updateTime')}
+            )
+            espera = 1
+            time.sleep(READINESS_CHECK_INTERVAL_SECONDS)
+        except Exception as e:
+            inicializado = False
+            _actualizar_estado(
+                earthEngine=False,
+                lastError=str(e),
+                lastCheck=datetime.datetime.utcnow().isoformat() + 'Z'
+            )
+            logger.error(f"Earth Engine no disponible (intento {_estado_inicio['attempts']}, reintento en {espera}s): {e}")
+            time.sleep(espera)
+            espera = min(espera * 2, EE_INIT_MAX_BACKOFF_SECONDS)
+
+def _cargar_caches():
+    """Registra los bloques de rasters ya presentes en disco; no depende de Earth Engine."""
+    try:
+        bloques = raster_cache.registrar_existentes()
+        logger.info(f"Raster cache loaded: {bloques} chunks.")
+    except Exception as e:
+        # La caché sigue siendo utilizable: los bloques no registrados se releen bajo demanda.
+        logger.error(f"Error al cargar la caché de rasters: {e}", exc_info=True)
+    _actualizar_estado(caches=True)
+
+def iniciar_en_segundo_plano():
+    """Arranca la supervisión de Earth Engine y la carga de cachés.
+
+    No se ejecuta al importar el módulo: lo llama el bloque `__main__` en el proceso que
+    sirve, o el hook de arranque de cada worker si se usa otro servidor WSGI.
+    """
+    hilos = [
+        threading.Thread(target=_supervisar_earth_engine, name='ee-monitor', daemon=True),
+        threading.Thread(target=_cargar_caches, name='cache-load', daemon=True)
+    ]
+    for hilo in hilos:
+        hilo.start()
+    return hilos
+
+class EarthEngineNoDisponible(Exception):
+    """Se necesita Earth Engine y la réplica no está lista."""
+
+def _respuesta_no_disponible():
+    respuesta = jsonify({'error': 'El servicio no está listo (iniciando o sin conexión con Earth Engine). Intente nuevamente en unos segundos.'})
+    respuesta.status_code = 503
+    respuesta.headers['Retry-After'] = '5'
+    return respuesta
+
+def requiere_earth_engine(vista):
+    """Responde 503 mientras Earth Engine y las cachés no estén listos.
+
+    Se aplica solo a rutas que consultan Earth Engine; las respuestas servibles sin EE
+    (304, caché HTTP, bloques de rasters en disco) comprueban la disponibilidad más tarde.
+    """
+    @functools.wraps(vista)
+    def envoltura(*args, **kwargs):
+        if not _listo.is_set():
+            return _respuesta_no_disponible()
+        return vista(*args, **kwargs)
+    return envoltura
+
+@app.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    with _estado_inicio_lock:
+        estado = dict(_estado_inicio)
+    listo = _listo.is_set()
+    estado['status'] = 'ready' if listo else 'not_ready'
+    return jsonify(estado), 200 if listo else 503
+
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+def _normalizar_solicitud(parametros):
+    """Devuelve la clave normalizada (ruta + fechas ISO) o None si alguna fecha no es canónica."""
+    fechas = []
+    for nombre in parametros:
+        valor = request.args.get(nombre)
+        if not valor:
+            return None
+        try:
+            fecha = datetime.datetime.strptime(valor, '%Y-%m-%d').date()
+        except ValueError:
+            return None
+        # Solo la forma canónica; cualquier otra la resuelve la vista, sin depender de la caché.
+        if valor != fecha.isoformat():
+            return None
+        fechas.append(fecha)
+    clave = json.dumps({
+        'path': request.path,
+        'params': {nombre: fecha.isoformat() for nombre, fecha in zip(parametros, fechas)},
+        'version': ALGORITHM_VERSION
+    }, sort_keys=True)
+    return clave, fechas
+
+def _ventana_abierta(fecha):
+    """Una ventana que termina hoy o después aún puede recibir escenas nuevas."""
+    return fecha + datetime.timedelta(days=WINDOW_HALF_DAYS) >= datetime.datetime.utcnow().date()
+
+def _ttl_para_fechas(fechas):
+    """Las ventanas históricas viven lo que el map ID; las que siguen abiertas, menos."""
+    if any(_ventana_abierta(fecha) for fecha in fechas):
+        return min(MAP_ID_TTL_SECONDS, RECENT_WINDOW_TTL_SECONDS)
+    return MAP_ID_TTL_SECONDS
+
+def _periodo_vigente(clave, ttl):
+    """Periodo de emisión determinista: todas las réplicas comparten ETag y expiración.
+
+    Los periodos se alinean a múltiplos de `ttl` desde la época Unix. Un map ID emitido
+    dentro del periodo sigue vigente hasta su final, porque vive al menos `ttl` segundos.
+    """
+    periodo = int(time.time() // ttl)
+    digest = hashlib.sha256(f'{clave}|{ttl}|{periodo}'.encode('utf-8')).hexdigest()
+    return digest[:32], periodo * ttl, (periodo + 1) * ttl
+
+def _obtener_respuesta_cacheada(clave, etag):
+    with _response_cache_lock:
+        entrada = _response_cache.get(clave)
+        if entrada is None:
+            return None
+        if entrada['etag'] != etag:
+            del _response_cache[clave]
+            return None
+        _response_cache.move_to_end(clave)
+        return entrada
+
+def _guardar_respuesta_cacheada(clave, etag, body, mimetype):
+    entrada = {
+        'etag': etag,
+        'body': body,
+        'mimetype': mimetype
+    }
+    with _response_cache_lock:
+        _response_cache[clave] = entrada
+        _response_cache.move_to_end(clave)
+        while len(_response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            _response_cache.popitem(last=False)
+    return entrada
+
+def _respuesta_cacheable(etag, expires_at, body=None, mimetype=None):
+    if body is None:
+        respuesta = app.response_class(status=304)
+    else:
+        respuesta = app.response_class(body, mimetype=mimetype)
+    respuesta.set_etag(etag)
+    respuesta.cache_control.public = True
+    respuesta.cache_control.max_age = max(0, int(expires_at - time.time()))
+    respuesta.expires = expires_at
+    return respuesta
+
+def respuesta_cacheable(*parametros):
+    """Aplica ETag, Cache-Control y GET condicional a endpoints deterministas de capas.
+
+    El ETag depende solo de la solicitud normalizada, ALGORITHM_VERSION y el periodo de
+    vigencia del map ID, así que un If-None-Match coincidente recibe 304 sin consultar
+    Earth Engine aunque esta réplica no tenga la respuesta en memoria. El tileUrl puede
+    diferir entre réplicas dentro del mismo periodo, pero ambos sirven el mismo mosaico.
+    """
+    def decorador(vista):
+        @functools.wraps(vista)
+        def envoltura(*args, **kwargs):
+            normalizada = _normalizar_solicitud(parametros)
+            if normalizada is None:
+                return requiere_earth_engine(vista)(*args, **kwargs)
+            clave, fechas = normalizada
+            etag, emitido, expires_at = _periodo_vigente(clave, _ttl_para_fechas(fechas))
+
+            if request.if_none_match.contains(etag):
+                logger.debug(f"Not modified for {request.path} ({etag})")
+                return _respuesta_cacheable(etag, expires_at)
+
+            entrada = _obtener_respuesta_cacheada(clave, etag)
+            if entrada is not None:
+                logger.debug(f"Serving cached response for {request.path} ({etag})")
+                return _respuesta_cacheable(etag, expires_at, entrada['body'], entrada['mimetype'])
+
+            respuesta = app.make_response(requiere_earth_engine(vista)(*args, **kwargs))
+            if respuesta.status_code != 200:
+                return respuesta
+            payload = respuesta.get_json()
+            if 'processingDate' in payload:
+                # Fecha del periodo, no de la llamada, para que el cuerpo no varíe entre réplicas.
+                payload['processingDate'] = datetime.datetime.utcfromtimestamp(emitido).isoformat() + 'Z'
+            entrada = _guardar_respuesta_cacheada(clave, etag, jsonify(payload).get_data(), respuesta.mimetype)
+            return _respuesta_cacheable(etag, expires_at, entrada['body'], entrada['mimetype'])
+        return envoltura
+    return decorador
+
 def reflectance(image, band):
     logger.debug(f"Calculating reflectance for band: {band}")
     return image.select(band).multiply(0.0000275).add(-0.2)
@@ -29,7 +315,7 @@ def crear_mosaico_ndvi_periodo(fecha_str):
     logger.debug(f"Calculated date range: {start_date} to {end_date}")
 
     coleccion = (
-        ee.ImageCollection('LANDSAT/LC08/C02/T1_L2')
+        _objetos_compartidos['coleccion']
         .filterDate(start_date, end_date)
         #.filterMetadata('CLOUD_COVER', 'less_than', 50) Temporalmente para pruebas de alerta de nubosidad
         .filterMetadata('CLOUD_COVER', 'less_than', 50)
@@ -98,7 +384,7 @@ def crear_mosaico_savi_periodo(fecha_str):
     logger.debug(f"Calculated date range: {start_date} to {end_date}")
 
     coleccion = (
-        ee.ImageCollection('LANDSAT/LC08/C02/T1_L2')
+        _objetos_compartidos['coleccion']
         .filterDate(start_date, end_date)
         .filterMetadata('CLOUD_COVER', 'less_than', 50)
     )
@@ -125,6 +411,7 @@ def crear_mosaico_savi_periodo(fecha_str):
     return savi_mosaic, cloud_mosaic, start_date, end_date, cloud_cover_value
 
 @app.route('/gee-tile-url')
+@respuesta_cacheable('date')
 def get_tile_url():
     logger.info("Received request for /gee-tile-url")
     date = request.args.get('date')
@@ -142,16 +429,14 @@ def get_tile_url():
 
         logger.info(f"NDVI mosaic created. Cloud cover: {cloud_cover_value}")
         
-        min_val, max_val = -0.1, 0.9
-        palette = ['#8c510a', '#d8b365', '#f6e8c3', '#c7eae5', '#5ab4ac', '#01665e']
-        ndvi_vis_params = {'min': min_val, 'max': max_val, 'palette': palette}
+        ndvi_vis_params = VIS_PARAMS['NDVI']
+        min_val, max_val, palette = ndvi_vis_params['min'], ndvi_vis_params['max'], ndvi_vis_params['palette']
         
         # Visualize NDVI
         ndvi_visual = ndvi.visualize(**ndvi_vis_params)
 
         # Create a light blue image that is masked by the `clouds` mask.
-        light_blue_image = ee.Image.constant([140, 160, 180]).uint8() # RGB for metallic blue
-        cloud_overlay = light_blue_image.updateMask(clouds) # Only show light blue where clouds are 1
+        cloud_overlay = _objetos_compartidos['capa_nubes'].updateMask(clouds) # Only show light blue where clouds are 1
         
         # Blend the cloud overlay on top of the NDVI visualization.
         final_visual = ee.Image.blend(ndvi_visual, cloud_overlay)
@@ -168,7 +453,7 @@ def get_tile_url():
             'processingDate': datetime.datetime.utcnow().isoformat() + 'Z',
             'calculationStartDate': start_date,
             'calculationEndDate': end_date,
-            'source': 'LANDSAT/LC08/C02/T1_L2',
+            'source': LANDSAT_COLLECTION,
             'legend': palette,
             'cloudCover': cloud_cover_value
         })
@@ -177,6 +462,7 @@ def get_tile_url():
         return jsonify({'error': f'Error de Earth Engine: {str(e)}'}), 500
 
 @app.route('/gee-ndvi-diff')
+@respuesta_cacheable('date1', 'date2')
 def diferencia_ndvi():
     logger.info("Received request for /gee-ndvi-diff")
     date1 = request.args.get('date1')
@@ -193,8 +479,7 @@ def diferencia_ndvi():
         diff = ndvi2.subtract(ndvi1).rename('NDVI_DIFF')
         logger.info("NDVI difference calculated.")
         
-        vis_params = {'min': -0.5, 'max': 0.5, 'palette': ['red', 'yellow', 'white', 'cyan', 'green']}
-        map_id = diff.getMapId(vis_params)
+        map_id = diff.getMapId(VIS_PARAMS['DIFF'])
         logger.info("Map ID obtained for NDVI difference.")
         
         return jsonify({
@@ -218,6 +503,7 @@ def diferencia_ndvi():
 
 
 @app.route('/gee-deforestation-zones-from-geojson', methods=['POST'])
+@requiere_earth_engine
 def zonas_deforestadas_geojson():
     logger.info("Received request for /gee-deforestation-zones-from-geojson")
     data = request.get_json()
@@ -285,6 +571,7 @@ def zonas_deforestadas_geojson():
 
 
 @app.route('/gee-savi-tile-url')
+@respuesta_cacheable('date')
 def get_savi_tile_url():
     logger.info("Received request for /gee-savi-tile-url")
     date = request.args.get('date')
@@ -302,14 +589,12 @@ def get_savi_tile_url():
 
         logger.info(f"SAVI mosaic created. Cloud cover: {cloud_cover_value}")
         
-        min_val, max_val = 0, 1 # Rango típico para SAVI
-        palette = ['brown', 'yellow', 'lightgreen', 'green', 'darkgreen'] # Paleta de ejemplo para SAVI
-        savi_vis_params = {'min': min_val, 'max': max_val, 'palette': palette}
+        savi_vis_params = VIS_PARAMS['SAVI']
+        min_val, max_val, palette = savi_vis_params['min'], savi_vis_params['max'], savi_vis_params['palette']
         
         savi_visual = savi.visualize(**savi_vis_params)
 
-        light_blue_image = ee.Image.constant([140, 160, 180]).uint8()
-        cloud_overlay = light_blue_image.updateMask(clouds)
+        cloud_overlay = _objetos_compartidos['capa_nubes'].updateMask(clouds)
         
         final_visual = ee.Image.blend(savi_visual, cloud_overlay)
 
@@ -325,7 +610,7 @@ def get_savi_tile_url():
             'processingDate': datetime.datetime.utcnow().isoformat() + 'Z',
             'calculationStartDate': start_date,
             'calculationEndDate': end_date,
-            'source': 'LANDSAT/LC08/C02/T1_L2',
+            'source': LANDSAT_COLLECTION,
             'legend': palette,
             'cloudCover': cloud_cover_value
         })
@@ -334,6 +619,7 @@ def get_savi_tile_url():
         return jsonify({'error': f'Error de Earth Engine: {str(e)}'}), 500
 
 @app.route('/gee-savi-diff')
+@respuesta_cacheable('date1', 'date2')
 def diferencia_savi():
     logger.info("Received request for /gee-savi-diff")
     date1 = request.args.get('date1')
@@ -354,8 +640,7 @@ def diferencia_savi():
         diff = savi2.subtract(savi1).rename('SAVI_DIFF')
         logger.info("SAVI difference calculated.")
         
-        vis_params = {'min': -0.5, 'max': 0.5, 'palette': ['red', 'yellow', 'white', 'cyan', 'green']} # Paleta similar a NDVI diff
-        map_id = diff.getMapId(vis_params)
+        map_id = diff.getMapId(VIS_PARAMS['DIFF'])
         logger.info("Map ID obtained for SAVI difference.")
         
         return jsonify({
@@ -371,6 +656,7 @@ def diferencia_savi():
         return jsonify({'error': f'Error al calcular diferencia SAVI: {str(e)}'}), 500
 
 @app.route('/gee-deforestation-zones-from-geojson-savi', methods=['POST'])
+@requiere_earth_engine
 def zonas_deforestadas_geojson_savi():
     logger.info("Received request for /gee-deforestation-zones-from-geojson-savi")
     data = request.get_json()
@@ -443,6 +729,7 @@ def zonas_deforestadas_geojson_savi():
 
 
 @app.route('/find-best-image-date', methods=['POST'])
+@requiere_earth_engine
 def find_best_image_date():
     logger.info("Received request for /find-best-image-date")
     data = request.get_json()
@@ -468,7 +755,7 @@ def find_best_image_date():
         search_end_date = (target_obj + datetime.timedelta(days=15)).strftime('%Y-%m-%d')
 
         collection = (
-            ee.ImageCollection('LANDSAT/LC08/C02/T1_L2')
+            _objetos_compartidos['coleccion']
             .filterDate(search_start_date, search_end_date)
             .sort('CLOUD_COVER')
         )
@@ -518,7 +805,7 @@ def crear_mosaico_nbr_periodo(fecha_str):
     logger.debug(f"Calculated date range: {start_date} to {end_date}")
 
     coleccion = (
-        ee.ImageCollection('LANDSAT/LC08/C02/T1_L2')
+        _objetos_compartidos['coleccion']
         .filterDate(start_date, end_date)
         .filterMetadata('CLOUD_COVER', 'less_than', 50)
     )
@@ -545,6 +832,7 @@ def crear_mosaico_nbr_periodo(fecha_str):
     return nbr_mosaic, cloud_mosaic, start_date, end_date, cloud_cover_value
 
 @app.route('/gee-nbr-tile-url')
+@respuesta_cacheable('date')
 def get_nbr_tile_url():
     logger.info("Received request for /gee-nbr-tile-url")
     date = request.args.get('date')
@@ -562,14 +850,12 @@ def get_nbr_tile_url():
 
         logger.info(f"NBR mosaic created. Cloud cover: {cloud_cover_value}")
         
-        min_val, max_val = -1, 1 # Rango típico para NBR
-        palette = ['red', 'orange', 'yellow', 'lightgreen', 'darkgreen'] # Paleta de ejemplo para NBR
-        nbr_vis_params = {'min': min_val, 'max': max_val, 'palette': palette}
+        nbr_vis_params = VIS_PARAMS['NBR']
+        min_val, max_val, palette = nbr_vis_params['min'], nbr_vis_params['max'], nbr_vis_params['palette']
         
         nbr_visual = nbr.visualize(**nbr_vis_params)
 
-        light_blue_image = ee.Image.constant([140, 160, 180]).uint8()
-        cloud_overlay = light_blue_image.updateMask(clouds)
+        cloud_overlay = _objetos_compartidos['capa_nubes'].updateMask(clouds)
         
         final_visual = ee.Image.blend(nbr_visual, cloud_overlay)
 
@@ -585,7 +871,7 @@ def get_nbr_tile_url():
             'processingDate': datetime.datetime.utcnow().isoformat() + 'Z',
             'calculationStartDate': start_date,
             'calculationEndDate': end_date,
-            'source': 'LANDSAT/LC08/C02/T1_L2',
+            'source': LANDSAT_COLLECTION,
             'legend': palette,
             'cloudCover': cloud_cover_value
         })
@@ -594,6 +880,7 @@ def get_nbr_tile_url():
         return jsonify({'error': f'Error de Earth Engine: {str(e)}'}), 500
 
 @app.route('/gee-nbr-diff')
+@respuesta_cacheable('date1', 'date2')
 def diferencia_nbr():
     logger.info("Received request for /gee-nbr-diff")
     date1 = request.args.get('date1')
@@ -614,8 +901,7 @@ def diferencia_nbr():
         diff = nbr2.subtract(nbr1).rename('NBR_DIFF')
         logger.info("NBR difference calculated.")
         
-        vis_params = {'min': -0.5, 'max': 0.5, 'palette': ['red', 'yellow', 'white', 'cyan', 'green']} # Paleta similar a NDVI diff
-        map_id = diff.getMapId(vis_params)
+        map_id = diff.getMapId(VIS_PARAMS['DIFF'])
         logger.info("Map ID obtained for NBR difference.")
         
         return jsonify({
@@ -631,6 +917,7 @@ def diferencia_nbr():
         return jsonify({'error': f'Error al calcular diferencia NBR: {str(e)}'}), 500
 
 @app.route('/gee-deforestation-zones-from-geojson-nbr', methods=['POST'])
+@requiere_earth_engine
 def zonas_deforestadas_geojson_nbr():
     logger.info("Received request for /gee-deforestation-zones-from-geojson-nbr")
     data = request.get_json()
@@ -702,9 +989,133 @@ def zonas_deforestadas_geojson_nbr():
         return jsonify({'error': f'Error al detectar zonas de deforestación con NBR: {str(e)}'}), 500
 
 
+def _ventana_fechas(fecha_str):
+    fecha_obj = datetime.datetime.strptime(fecha_str, '%Y-%m-%d')
+    start_date = (fecha_obj - datetime.timedelta(days=WINDOW_HALF_DAYS)).strftime('%Y-%m-%d')
+    end_date = (fecha_obj + datetime.timedelta(days=WINDOW_HALF_DAYS)).strftime('%Y-%m-%d')
+    return start_date, end_date
+
+MOSAICOS_POR_INDICE = {
+    'ndvi': ('NDVI', crear_mosaico_ndvi_periodo),
+    'savi': ('SAVI', crear_mosaico_savi_periodo),
+    'nbr': ('NBR', crear_mosaico_nbr_periodo)
+}
+
+def obtener_raster_local(geometry_data, fecha_str, indice, escala):
+    """Obtiene el índice y la máscara de nubes del AOI desde la caché local (o EE si faltan bloques)."""
+    banda, crear_mosaico = MOSAICOS_POR_INDICE[indice]
+    ventana = _ventana_fechas(fecha_str)
+
+    def construir_imagen():
+        # Solo se llama si faltan bloques: con todo en disco no hace falta Earth Engine.
+        if not _listo.is_set():
+            raise EarthEngineNoDisponible()
+        mosaico, nubes, _, _, _ = crear_mosaico(fecha_str)
+        if mosaico is None:
+            raise LookupError(f'No se pudo crear un mosaico {banda} para la fecha {fecha_str}.')
+        return mosaico.addBands(nubes)
+
+    fecha = datetime.datetime.strptime(fecha_str, '%Y-%m-%d').date()
+    ttl = RECENT_WINDOW_TTL_SECONDS if _ventana_abierta(fecha) else None
+    raster = raster_cache.obtener(geometry_data, ventana, banda, escala, construir_imagen, version=ALGORITHM_VERSION, ttl=ttl)
+    return raster, ventana
+
+def _parsear_escala(valor):
+    """Acepta solo enteros positivos (o su texto/float exacto); cualquier otro valor es ValueError."""
+    if isinstance(valor, bool):
+        raise ValueError(f'Escala inválida: {valor}. Use un entero positivo en metros.')
+    try:
+        escala = float(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f'Escala inválida: {valor}. Use un entero positivo en metros.')
+    if not escala.is_integer() or escala <= 0:
+        raise ValueError(f'Escala inválida: {valor}. Use un entero positivo en metros.')
+    return int(escala)
+
+def _parsear_umbral(valor):
+    """Acepta números finitos (o su texto); cualquier otro valor es ValueError."""
+    try:
+        umbral = float(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f'Umbral inválido: {valor}. Use un número.')
+    if isinstance(valor, bool) or not math.isfinite(umbral):
+        raise ValueError(f'Umbral inválido: {valor}. Use un número.')
+    return umbral
+
+@app.route('/local-deforestation-zones', methods=['POST'])
+def zonas_deforestadas_local():
+    logger.info("Received request for /local-deforestation-zones")
+    data = request.get_json()
+    if not data:
+        logger.warning("Invalid JSON body for /local-deforestation-zones")
+        return jsonify({'error': 'Cuerpo de la solicitud no es JSON válido'}), 400
+
+    date1 = data.get('date1')
+    date2 = data.get('date2')
+    geometry_data = data.get('geometry')
+    indice = str(data.get('index', 'ndvi')).lower()
+
+    if not all([date1, date2, geometry_data]):
+        logger.warning("Missing required parameters for /local-deforestation-zones")
+        return jsonify({'error': 'Faltan parámetros requeridos: date1, date2 o geometry'}), 400
+    if not isinstance(geometry_data, dict):
+        logger.warning("Invalid geometry for /local-deforestation-zones")
+        return jsonify({'error': 'geometry debe ser un objeto GeoJSON.'}), 400
+    if indice not in MOSAICOS_POR_INDICE:
+        return jsonify({'error': f'Índice no soportado: {indice}. Use ndvi, savi o nbr.'}), 400
+
+    try:
+        threshold = _parsear_umbral(data.get('threshold', 0.25))
+        escala = _parsear_escala(data.get('scale', 90))
+        logger.info(f"Processing local {indice.upper()} deforestation zones at {escala} m.")
+        base, (start1, end1) = obtener_raster_local(geometry_data, date1, indice, escala)
+        final, (start2, end2) = obtener_raster_local(geometry_data, date2, indice, escala)
+
+        deforestation_mask = mascara_deforestacion(base, final, threshold)
+        _, zone_count = etiquetar_zonas(deforestation_mask)
+        total_area_sq_m = base.area_m2()
+        deforested_area_sq_m = base.area_m2(deforestation_mask)
+        deforestation_percentage = (deforested_area_sq_m / total_area_sq_m * 100) if total_area_sq_m > 0 else 0
+        cloudy1 = (base.area_nubes_m2() / total_area_sq_m * 100) if total_area_sq_m > 0 else 0
+        cloudy2 = (final.area_nubes_m2() / total_area_sq_m * 100) if total_area_sq_m > 0 else 0
+        logger.info(f"Detected {zone_count} local deforestation zones. Total Area: {total_area_sq_m:.2f} sqm, Deforested Area: {deforested_area_sq_m:.2f} sqm, Percentage: {deforestation_percentage:.2f}%")
+
+        return jsonify({
+            'deforestationSummary': {
+                'index': indice,
+                'scale': escala,
+                'zoneCount': zone_count,
+                'deforestationDetected': zone_count > 0,
+                'threshold': threshold,
+                'dateBase': {'start': start1, 'end': end1},
+                'dateFinal': {'start': start2, 'end': end2},
+                'cloudyAreaPercentage1': cloudy1,
+                'cloudyAreaPercentage2': cloudy2,
+                'totalAreaSqM': total_area_sq_m,
+                'deforestedAreaSqM': deforested_area_sq_m,
+                'deforestationPercentage': deforestation_percentage
+            }
+        })
+    except EarthEngineNoDisponible:
+        logger.warning("Earth Engine not ready and raster chunks missing for /local-deforestation-zones")
+        return _respuesta_no_disponible()
+    except LookupError as e:
+        logger.warning(f"No suitable mosaic for /local-deforestation-zones: {e}")
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        logger.warning(f"Invalid parameters for /local-deforestation-zones: {e}")
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error en /local-deforestation-zones: {e}", exc_info=True)
+        return jsonify({'error': f'Error al detectar zonas de deforestación en caché local: {str(e)}'}), 500
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    debug = True
+    # Con el recargador de Werkzeug, el proceso padre solo vigila archivos; los hilos
+    # se inician únicamente en el proceso hijo que atiende solicitudes.
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        iniciar_en_segundo_plano()
+    app.run(debug=debug, host='0.0.0.0', port=5000)
 
 
@@ -0,0 +1,345 @@
+import concurrent.futures
+import hashlib
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from scipy import ndimage
+
+logger = logging.getLogger(__name__)
+
+NODATA = -9999
+CHUNK_SIZE = 256
+MAX_PIXELS = 4096 * 4096
+EARTH_RADIUS_M = 6378137.0
+BANDAS = ('valor', 'clouds', 'aoi')
+
+
+class EEPixelFetcher:
+    """Descarga bloques de píxeles desde Earth Engine con ee.data.computePixels.
+
+    Cualquier objeto con los métodos `preparar` y `obtener_bloque` puede sustituirlo
+    (por ejemplo, un fetcher falso en pruebas sin red).
+    """
+
+    def preparar(self, imagen, geometria, indice):
+        import ee
+        region = ee.Geometry(geometria)
+        aoi = ee.Image(1).clip(region).rename('aoi')
+        return (
+            imagen.select([indice, 'clouds'], ['valor', 'clouds'])
+            .toFloat()
+            .addBands(aoi.toFloat())
+            .unmask(NODATA)
+        )
+
+    def obtener_bloque(self, expresion, grid):
+        import ee
+        datos = ee.data.computePixels({
+            'expression': expresion,
+            'fileFormat': 'NUMPY_NDARRAY',
+            'grid': grid,
+            'bandIds': list(BANDAS)
+        })
+        return np.stack([datos[banda] for banda in BANDAS]).astype(np.float32)
+
+
+class RasterLocal:
+    """Índice compuesto, máscara de nubes y máscara del AOI, respaldados por los bloques memory-mapped.
+
+    No se copia el raster completo a RAM: cada operación recorre los bloques de uno en uno.
+    """
+
+    def __init__(self, bloques, bounds, paso, alto, ancho):
+        self.bloques = bloques  # (fila, columna) -> memmap (bandas, alto, ancho)
+        self.bounds = bounds
+        self.paso = paso
+        self.alto = alto
+        self.ancho = ancho
+
+    @property
+    def forma(self):
+        return self.alto, self.ancho
+
+    def _area_pixel(self, fila, filas):
+        """Área de píxel en m² por fila (depende de la latitud del centro del píxel)."""
+        latitudes = self.bounds[3] - (np.arange(fila, fila + filas) + 0.5) * self.paso
+        lado = EARTH_RADIUS_M * math.radians(self.paso)
+        return (lado * lado * np.cos(np.radians(latitudes)))[:, None]
+
+    def recorrer(self):
+        """Genera (fila, columna, valores, nubes, aoi) por bloque; los valores sin dato son NaN."""
+        for (fila, columna), bloque in sorted(self.bloques.items()):
+            valores = np.where(bloque[0] == NODATA, np.nan, bloque[0])
+            nubes = (bloque[1] != NODATA) & (bloque[1] > 0)
+            aoi = bloque[2] == 1
+            yield fila, columna, valores, nubes, aoi
+
+    def area_m2(self, mascara=None):
+        """Suma el área de los píxeles de la máscara (por defecto, todo el AOI)."""
+        total = 0.0
+        for fila, columna, _, _, aoi in self.recorrer():
+            if mascara is not None:
+                aoi = aoi & mascara[fila:fila + aoi.shape[0], columna:columna + aoi.shape[1]]
+            total += float(np.sum(aoi * self._area_pixel(fila, aoi.shape[0])))
+        return total
+
+    def area_nubes_m2(self):
+        total = 0.0
+        for fila, _, _, nubes, aoi in self.recorrer():
+            total += float(np.sum((nubes & aoi) * self._area_pixel(fila, aoi.shape[0])))
+        return total
+
+
+def _comprobar_grilla(base, final):
+    if base.forma != final.forma:
+        raise ValueError('Los rasters no comparten la misma grilla.')
+
+
+def diferencia(base, final):
+    """Diferencia píxel a píxel (final - base) entre dos rasters del mismo AOI, como float32."""
+    _comprobar_grilla(base, final)
+    resultado = np.empty(base.forma, dtype=np.float32)
+    for (fila, columna, valores_base, _, _), (_, _, valores_final, _, _) in zip(base.recorrer(), final.recorrer()):
+        resultado[fila:fila + valores_base.shape[0], columna:columna + valores_base.shape[1]] = valores_final - valores_base
+    return resultado
+
+
+def mascara_deforestacion(base, final, umbral, minimo_base=0.4):
+    """Misma regla que los endpoints de Earth Engine: índice base alto y caída mayor al umbral."""
+    _comprobar_grilla(base, final)
+    mascara = np.zeros(base.forma, dtype=bool)
+    for (fila, columna, valores_base, _, aoi), (_, _, valores_final, _, _) in zip(base.recorrer(), final.recorrer()):
+        with np.errstate(invalid='ignore'):
+            bloque = (valores_base > minimo_base) & ((valores_base - valores_final) > umbral) & aoi
+        mascara[fila:fila + bloque.shape[0], columna:columna + bloque.shape[1]] = bloque
+    return mascara
+
+
+def etiquetar_zonas(mascara):
+    """Etiqueta componentes conexas (8 vecinos), como reduceToVectors en Earth Engine.
+
+    Devuelve un arreglo de etiquetas (-1 fuera de la máscara) y el número de zonas.
+    """
+    etiquetas, zonas = ndimage.label(mascara, structure=np.ones((3, 3), dtype=bool))
+    return etiquetas - 1, zonas
+
+
+def hash_geometria(geometria):
+    normalizada = json.dumps(geometria, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(normalizada.encode('utf-8')).hexdigest()[:16]
+
+
+def bounds_geometria(geometria):
+    """Caja envolvente (oeste, sur, este, norte) de una geometría GeoJSON en EPSG:4326."""
+    xs, ys = [], []
+
+    def recorrer(coordenadas):
+        if coordenadas and isinstance(coordenadas[0], (int, float)):
+            xs.append(coordenadas[0])
+            ys.append(coordenadas[1])
+        else:
+            for coordenada in coordenadas:
+                recorrer(coordenada)
+
+    try:
+        if geometria.get('type') == 'GeometryCollection':
+            for parte in geometria.get('geometries', []):
+                recorrer(parte.get('coordinates', []))
+        else:
+            recorrer(geometria.get('coordinates', []))
+    except (AttributeError, IndexError, TypeError):
+        raise ValueError('La geometría no es un GeoJSON válido.')
+    if not xs:
+        raise ValueError('La geometría no contiene coordenadas.')
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+class RasterCache:
+    """Caché local de rasters por AOI, en bloques .npy memory-mapped con desalojo LRU.
+
+    Clave: (versión del algoritmo, hash del AOI, ventana de fechas, índice, escala). Solo los
+    bloques que faltan se piden a Earth Engine, en paralelo; si la clave tiene `ttl` (ventanas
+    aún abiertas), se descarga completa de nuevo cuando vence o le falta algún bloque. Los bloques en disco se limitan a `max_bytes`; en
+    RAM solo se materializa un bloque a la vez más las máscaras booleanas de tamaño AOI.
+    """
+
+    def __init__(self, directorio=None, max_bytes=512 * 1024 * 1024, fetcher=None, max_workers=8, registrar_existentes=True):
+        self.directorio = directorio or os.path.join(tempfile.gettempdir(), 'agri-deforest-raster-cache')
+        self.max_bytes = max_bytes
+        self.fetcher = fetcher or EEPixelFetcher()
+        self.max_workers = max_workers
+        self._bloques = OrderedDict()  # ruta -> (tamaño en bytes, memmap o None)
+        self._bytes = 0
+        self._fijados = {}  # ruta -> número de llamadas a `obtener` que la usan
+        self._lock = threading.Lock()
+        os.makedirs(self.directorio, exist_ok=True)
+        if registrar_existentes:
+            self.registrar_existentes()
+
+    def registrar_existentes(self):
+        """Registra en el LRU los bloques ya presentes en disco; devuelve cuántos hay."""
+        encontrados = []
+        for raiz, _, archivos in os.walk(self.directorio):
+            for archivo in archivos:
+                if archivo.endswith('.npy'):
+                    ruta = os.path.join(raiz, archivo)
+                    encontrados.append((os.path.getmtime(ruta), ruta))
+        for _, ruta in sorted(encontrados):
+            self._registrar(ruta, None)
+        return len(encontrados)
+
+    def _registrar(self, ruta, arreglo):
+        with self._lock:
+            if ruta in self._bloques:
+                tamaño, previo = self._bloques.pop(ruta)
+                self._bytes -= tamaño
+                arreglo = arreglo if arreglo is not None else previo
+            tamaño = os.path.getsize(ruta)
+            self._bloques[ruta] = (tamaño, arreglo)
+            self._bytes += tamaño
+            self._desalojar()
+
+    def _desalojar(self):
+        for ruta in list(self._bloques):
+            if self._bytes <= self.max_bytes:
+                break
+            if ruta in self._fijados:
+                continue
+            tamaño, _ = self._bloques.pop(ruta)
+            self._bytes -= tamaño
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+            logger.debug(f"Evicted raster chunk {ruta}")
+
+    def _fijar(self, rutas):
+        with self._lock:
+            for ruta in rutas:
+                self._fijados[ruta] = self._fijados.get(ruta, 0) + 1
+
+    def _liberar(self, rutas):
+        with self._lock:
+            for ruta in rutas:
+                if self._fijados[ruta] == 1:
+                    del self._fijados[ruta]
+                else:
+                    self._fijados[ruta] -= 1
+            self._desalojar()
+
+    def _descartar(self, rutas):
+        with self._lock:
+            for ruta in rutas:
+                entrada = self._bloques.pop(ruta, None)
+                if entrada is not None:
+                    self._bytes -= entrada[0]
+                try:
+                    os.remove(ruta)
+                except OSError:
+                    pass
+
+    def _vencida(self, rutas, ttl):
+        """Una clave con TTL vence como unidad, para no mezclar mosaicos de distintos momentos."""
+        fechas = [os.path.getmtime(ruta) for ruta in rutas if os.path.exists(ruta)]
+        return bool(fechas) and (len(fechas) < len(rutas) or time.time() - min(fechas) > ttl)
+
+    def _leer(self, ruta):
+        with self._lock:
+            entrada = self._bloques.get(ruta)
+            if entrada is not None:
+                self._bloques.move_to_end(ruta)
+                if entrada[1] is not None:
+                    return entrada[1]
+        if not os.path.exists(ruta):
+            return None
+        arreglo = np.load(ruta, mmap_mode='r')
+        self._registrar(ruta, arreglo)
+        return arreglo
+
+    def _escribir(self, ruta, bloque):
+        temporal = f'{ruta}.{threading.get_ident()}.tmp'
+        with open(temporal, 'wb') as archivo:
+            np.save(archivo, bloque)
+        os.replace(temporal, ruta)
+        arreglo = np.load(ruta, mmap_mode='r')
+        self._registrar(ruta, arreglo)
+        return arreglo
+
+    def grilla(self, geometria, escala):
+        """Calcula la grilla EPSG:4326 del AOI para una escala en metros."""
+        if escala <= 0:
+            raise ValueError(f'La escala debe ser positiva: {escala}.')
+        oeste, sur, este, norte = bounds_geometria(geometria)
+        paso = math.degrees(escala / EARTH_RADIUS_M)
+        ancho = max(1, math.ceil((este - oeste) / paso))
+        alto = max(1, math.ceil((norte - sur) / paso))
+        if ancho * alto > MAX_PIXELS:
+            raise ValueError(f'El AOI requiere {ancho * alto} píxeles a {escala} m; el máximo es {MAX_PIXELS}.')
+        return (oeste, sur, este, norte), paso, ancho, alto
+
+    def obtener(self, geometria, ventana, indice, escala, construir_imagen, version='', ttl=None):
+        """Devuelve un RasterLocal; solo llama a `construir_imagen` si faltan bloques.
+
+        `ttl` (segundos) se usa en ventanas que aún pueden recibir escenas nuevas; sin él,
+        los bloques se consideran inmutables.
+        """
+        bounds, paso, ancho, alto = self.grilla(geometria, escala)
+        tamaño = len(BANDAS) * np.dtype(np.float32).itemsize * alto * ancho
+        if tamaño > self.max_bytes:
+            raise ValueError(f'El AOI ocupa {tamaño} bytes a {escala} m y supera la caché local ({self.max_bytes} bytes).')
+        clave = f'v{version}_{hash_geometria(geometria)}_{ventana[0]}_{ventana[1]}_{indice}_{escala}'
+        directorio = os.path.join(self.directorio, clave)
+        os.makedirs(directorio, exist_ok=True)
+
+        rutas = {
+            (fila, columna): os.path.join(directorio, f'{fila}_{columna}.npy')
+            for fila in range(0, alto, CHUNK_SIZE)
+            for columna in range(0, ancho, CHUNK_SIZE)
+        }
+        # Los bloques de esta clave no se desalojan mientras se descargan los que faltan.
+        self._fijar(rutas.values())
+        try:
+            if ttl is not None and self._vencida(list(rutas.values()), ttl):
+                logger.info(f"Discarding expired raster chunks for {clave}")
+                self._descartar(rutas.values())
+            bloques = {}
+            faltantes = []
+            for (fila, columna), ruta in rutas.items():
+                arreglo = self._leer(ruta)
+                if arreglo is None:
+                    faltantes.append((fila, columna, ruta))
+                else:
+                    bloques[(fila, columna)] = arreglo
+
+            if faltantes:
+                logger.info(f"Fetching {len(faltantes)} raster chunks for {clave}")
+                expresion = self.fetcher.preparar(construir_imagen(), geometria, indice)
+
+                def descargar(fila, columna, ruta):
+                    grid = {
+                        'dimensions': {
+                            'width': min(CHUNK_SIZE, ancho - columna),
+                            'height': min(CHUNK_SIZE, alto - fila)
+                        },
+                        'affineTransform': {
+                            'scaleX': paso, 'shearX': 0, 'translateX': bounds[0] + columna * paso,
+                            'shearY': 0, 'scaleY': -paso, 'translateY': bounds[3] - fila * paso
+                        },
+                        'crsCode': 'EPSG:4326'
+                    }
+                    return self._escribir(ruta, self.fetcher.obtener_bloque(expresion, grid))
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as ejecutor:
+                    futuros = {ejecutor.submit(descargar, *faltante): faltante[:2] for faltante in faltantes}
+                    for futuro in concurrent.futures.as_completed(futuros):
+                        bloques[futuros[futuro]] = futuro.result()
+        finally:
+            self._liberar(rutas.values())
+        return RasterLocal(bloques, bounds, paso, alto, ancho)
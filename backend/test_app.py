@@ -0,0 +1,106 @@
+import datetime
+import time
+import types
+
+import pytest
+from flask import jsonify, request
+
+import app as servidor
+
+llamadas = []
+respuesta_falsa = {'status': 200}
+
+
+@servidor.app.route('/test-capa')
+@servidor.respuesta_cacheable('date')
+def capa_falsa():
+    """Vista falsa con la misma forma que los endpoints de capas, sin Earth Engine."""
+    llamadas.append(request.args['date'])
+    return jsonify({'tileUrl': f'https://tiles/{len(llamadas)}', 'processingDate': 'ahora'}), respuesta_falsa['status']
+
+
+@pytest.fixture
+def cliente(monkeypatch):
+    reloj = [7200 * 1000 + 100.0]
+    monkeypatch.setattr(servidor, 'time', types.SimpleNamespace(time=lambda: reloj[0], sleep=time.sleep))
+    monkeypatch.setattr(servidor, 'MAP_ID_TTL_SECONDS', 7200)
+    monkeypatch.setattr(servidor, 'RECENT_WINDOW_TTL_SECONDS', 900)
+    servidor._response_cache.clear()
+    llamadas.clear()
+    respuesta_falsa['status'] = 200
+    servidor._listo.set()
+    cliente = servidor.app.test_client()
+    cliente.reloj = reloj
+    yield cliente
+    servidor._listo.clear()
+    servidor._response_cache.clear()
+
+
+def test_respuesta_200_con_etag_y_max_age(cliente):
+    respuesta = cliente.get('/test-capa?date=2020-01-01')
+
+    assert respuesta.status_code == 200
+    assert respuesta.headers['ETag']
+    assert respuesta.cache_control.public
+    assert respuesta.cache_control.max_age == 7200 - 100
+    assert respuesta.json['processingDate'] == datetime.datetime.utcfromtimestamp(7200 * 1000).isoformat() + 'Z'
+
+    repetida = cliente.get('/test-capa?date=2020-01-01')
+    assert repetida.get_data() == respuesta.get_data()
+    assert llamadas == ['2020-01-01']
+
+
+def test_if_none_match_devuelve_304_sin_llamar_a_la_vista(cliente):
+    etag = cliente.get('/test-capa?date=2020-01-01').headers['ETag']
+    # Otra réplica o un reinicio: sin respuesta en memoria y sin Earth Engine.
+    servidor._response_cache.clear()
+    servidor._listo.clear()
+
+    respuesta = cliente.get('/test-capa?date=2020-01-01', headers={'If-None-Match': etag})
+
+    assert respuesta.status_code == 304
+    assert respuesta.headers['ETag'] == etag
+    assert llamadas == ['2020-01-01']
+
+
+def test_ventana_abierta_limita_max_age(cliente):
+    hoy = datetime.datetime.utcnow().date().isoformat()
+
+    respuesta = cliente.get(f'/test-capa?date={hoy}')
+
+    assert respuesta.cache_control.max_age <= 900
+
+
+@pytest.mark.parametrize('fecha', ['2020-1-1', '%202020-01-01', 'no-es-fecha'])
+def test_fecha_no_canonica_no_se_cachea(cliente, fecha):
+    primera = cliente.get(f'/test-capa?date={fecha}')
+    segunda = cliente.get(f'/test-capa?date={fecha}')
+
+    assert 'ETag' not in primera.headers
+    assert 'ETag' not in segunda.headers
+    assert len(llamadas) == 2
+
+
+def test_respuesta_distinta_de_200_no_se_cachea(cliente):
+    respuesta_falsa['status'] = 404
+
+    primera = cliente.get('/test-capa?date=2020-01-01')
+    segunda = cliente.get('/test-capa?date=2020-01-01')
+
+    assert primera.status_code == segunda.status_code == 404
+    assert 'ETag' not in primera.headers
+    assert len(llamadas) == 2
+
+
+def test_cambio_de_periodo_emite_nuevo_etag(cliente):
+    cliente.reloj[0] = 7200 * 1001 - 1
+    anterior = cliente.get('/test-capa?date=2020-01-01')
+    assert anterior.cache_control.max_age == 1
+
+    cliente.reloj[0] = 7200 * 1001 + 1
+    respuesta = cliente.get('/test-capa?date=2020-01-01', headers={'If-None-Match': anterior.headers['ETag']})
+
+    assert respuesta.status_code == 200
+    assert respuesta.headers['ETag'] != anterior.headers['ETag']
+    assert respuesta.cache_control.max_age == 7200 - 1
+    assert len(llamadas) == 2
@@ -0,0 +1,153 @@
+import math
+import os
+import time
+
+import numpy as np
+import pytest
+
+import raster_cache as rc
+
+ESCALA = 30
+PASO = math.degrees(ESCALA / rc.EARTH_RADIUS_M)
+OESTE, NORTE = -75.0, -9.9
+
+
+def geometria(pixeles):
+    este = OESTE + pixeles * PASO - PASO / 2
+    sur = NORTE - pixeles * PASO + PASO / 2
+    return {'type': 'Polygon', 'coordinates': [[[OESTE, sur], [este, sur], [este, NORTE], [OESTE, NORTE], [OESTE, sur]]]}
+
+
+class FetcherFalso:
+    """Codifica la posición global de cada píxel como fila * 1000 + columna, sin red."""
+
+    def __init__(self):
+        self.bloques = 0
+
+    def preparar(self, imagen, geometria, indice):
+        return imagen
+
+    def obtener_bloque(self, expresion, grid):
+        self.bloques += 1
+        ancho = grid['dimensions']['width']
+        alto = grid['dimensions']['height']
+        fila0 = round((NORTE - grid['affineTransform']['translateY']) / PASO)
+        columna0 = round((grid['affineTransform']['translateX'] - OESTE) / PASO)
+        valores = np.add.outer(np.arange(fila0, fila0 + alto) * 1000, np.arange(columna0, columna0 + ancho))
+        nubes = np.zeros((alto, ancho))
+        aoi = np.ones((alto, ancho))
+        return np.stack([valores + expresion, nubes, aoi]).astype(np.float32)
+
+
+def ensamblar(raster):
+    completo = np.empty(raster.forma, dtype=np.float32)
+    for fila, columna, valores, _, _ in raster.recorrer():
+        completo[fila:fila + valores.shape[0], columna:columna + valores.shape[1]] = valores
+    return completo
+
+
+def test_obtener_ensambla_bloques_en_su_posicion(tmp_path):
+    fetcher = FetcherFalso()
+    cache = rc.RasterCache(str(tmp_path), fetcher=fetcher)
+
+    raster = cache.obtener(geometria(300), ('2020-01-01', '2020-03-01'), 'NDVI', ESCALA, lambda: 0)
+
+    assert raster.forma == (300, 300)
+    assert fetcher.bloques == 4
+    esperado = np.add.outer(np.arange(300) * 1000, np.arange(300))
+    np.testing.assert_array_equal(ensamblar(raster), esperado)
+
+
+def test_segunda_llamada_no_vuelve_a_descargar(tmp_path):
+    fetcher = FetcherFalso()
+    cache = rc.RasterCache(str(tmp_path), fetcher=fetcher)
+    cache.obtener(geometria(300), ('2020-01-01', '2020-03-01'), 'NDVI', ESCALA, lambda: 0)
+
+    def sin_earth_engine():
+        raise AssertionError('no debería construir la imagen')
+
+    raster = cache.obtener(geometria(300), ('2020-01-01', '2020-03-01'), 'NDVI', ESCALA, sin_earth_engine)
+
+    assert fetcher.bloques == 4
+    assert ensamblar(raster)[299, 299] == 299299
+    # Una caché nueva sobre el mismo directorio reutiliza los bloques en disco.
+    otra = rc.RasterCache(str(tmp_path), fetcher=fetcher)
+    otra.obtener(geometria(300), ('2020-01-01', '2020-03-01'), 'NDVI', ESCALA, sin_earth_engine)
+    assert fetcher.bloques == 4
+
+
+def test_desalojo_lru(tmp_path):
+    fetcher = FetcherFalso()
+    tamaño_bloque = 128 + 3 * 4 * 10 * 10  # cabecera .npy + 3 bandas float32 de 10x10
+    cache = rc.RasterCache(str(tmp_path), max_bytes=2 * tamaño_bloque + 100, fetcher=fetcher)
+    aoi = geometria(10)
+
+    cache.obtener(aoi, ('a', 'a'), 'NDVI', ESCALA, lambda: 0)
+    cache.obtener(aoi, ('b', 'b'), 'NDVI', ESCALA, lambda: 0)
+    cache.obtener(aoi, ('a', 'a'), 'NDVI', ESCALA, lambda: 0)
+    assert fetcher.bloques == 2
+
+    # 'b' es el menos usado recientemente y se desaloja al entrar 'c'.
+    cache.obtener(aoi, ('c', 'c'), 'NDVI', ESCALA, lambda: 0)
+    cache.obtener(aoi, ('a', 'a'), 'NDVI', ESCALA, lambda: 0)
+    assert fetcher.bloques == 3
+    cache.obtener(aoi, ('b', 'b'), 'NDVI', ESCALA, lambda: 0)
+    assert fetcher.bloques == 4
+
+
+def test_rechaza_aoi_mayor_que_la_cache(tmp_path):
+    cache = rc.RasterCache(str(tmp_path), max_bytes=1024, fetcher=FetcherFalso())
+    with pytest.raises(ValueError):
+        cache.obtener(geometria(300), ('a', 'a'), 'NDVI', ESCALA, lambda: 0)
+
+
+def test_mascara_zonas_y_areas(tmp_path):
+    cache = rc.RasterCache(str(tmp_path), fetcher=FetcherFalso())
+    aoi = geometria(300)
+    base = cache.obtener(aoi, ('a', 'a'), 'NDVI', ESCALA, lambda: 0)
+    final = cache.obtener(aoi, ('b', 'b'), 'NDVI', ESCALA, lambda: -1)
+
+    mascara = rc.mascara_deforestacion(base, final, umbral=0.5)
+    _, zonas = rc.etiquetar_zonas(mascara)
+
+    # Solo el píxel (0, 0) tiene un índice base <= 0.4.
+    assert mascara.sum() == 300 * 300 - 1
+    assert zonas == 1
+    assert base.area_m2(mascara) < base.area_m2()
+    assert base.area_nubes_m2() == 0
+    np.testing.assert_array_equal(rc.diferencia(base, final), np.full((300, 300), -1, dtype=np.float32))
+
+
+def test_clave_con_ttl_vence_completa(tmp_path):
+    fetcher = FetcherFalso()
+    cache = rc.RasterCache(str(tmp_path), fetcher=fetcher)
+    aoi = geometria(300)
+    cache.obtener(aoi, ('a', 'a'), 'NDVI', ESCALA, lambda: 0, ttl=900)
+    cache.obtener(aoi, ('a', 'a'), 'NDVI', ESCALA, lambda: 0, ttl=900)
+    assert fetcher.bloques == 4
+
+    # Un solo bloque vencido obliga a descargar la clave completa.
+    vencido = next(tmp_path.rglob('0_0.npy'))
+    os.utime(vencido, (time.time() - 1000, time.time() - 1000))
+    raster = cache.obtener(aoi, ('a', 'a'), 'NDVI', ESCALA, lambda: 5, ttl=900)
+    assert fetcher.bloques == 8
+    assert ensamblar(raster)[299, 299] == 299304
+
+
+def test_version_forma_parte_de_la_clave(tmp_path):
+    fetcher = FetcherFalso()
+    cache = rc.RasterCache(str(tmp_path), fetcher=fetcher)
+    cache.obtener(geometria(10), ('a', 'a'), 'NDVI', ESCALA, lambda: 0, version='1')
+    cache.obtener(geometria(10), ('a', 'a'), 'NDVI', ESCALA, lambda: 0, version='2')
+    assert fetcher.bloques == 2
+
+
+@pytest.mark.parametrize('invalida', [
+    {'type': 'Polygon', 'coordinates': 5},
+    {'type': 'Polygon', 'coordinates': [[[-75]]]},
+    {'type': 'GeometryCollection', 'geometries': ['x']},
+    {'type': 'Polygon', 'coordinates': []},
+])
+def test_bounds_rechaza_geometrias_invalidas(invalida):
+    with pytest.raises(ValueError):
+        rc.bounds_geometria(invalida)